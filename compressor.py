@@ -0,0 +1,192 @@
+
+import hashlib
+import math
+import re
+from collections import OrderedDict, deque
+from typing import Dict, Any, List, Optional
+
+_CJK_RE = re.compile(r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+# 闭合代码块，以及末尾未闭合的代码块 (粘贴被截断时常见)
+_CODE_BLOCK_RE = re.compile(r"```[ \t]*([\w+#.-]*)[^\n]*\n(.*?)(?:```|\Z)", re.S)
+_BLANK_RE = re.compile(r"[ \t]+")
+_NEWLINES_RE = re.compile(r"\n{2,}")
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap local token estimate: ~1 token per CJK char, ~4 chars per token otherwise."""
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+class ContextCompressor:
+    """
+    Compresses router context to a total token budget.
+    Long messages keep a head and tail slice, code blocks collapse into
+    placeholders, and older turns that do not fit are reduced to one-line
+    digest entries. Each session also keeps a rolling digest: when a message
+    leaves the context window its digest line is appended there (trimmed to
+    ROLLING_DIGEST_TOKENS), so turns from further back still reach the router.
+    Per-message results are cached per session, so each turn only processes
+    messages it has not seen before.
+    """
+
+    CODE_KEEP_LINES = 3  # 不超过该行数的代码块原样保留
+    DIGEST_TOKENS = 24  # 旧消息摘要行的 token 上限
+    SESSIONS_MAX = 200
+    ENTRIES_PER_SESSION = 64
+    ROLLING_DIGEST_TOKENS = 200  # 滚动摘要的 token 上限，超出丢弃最旧的行
+
+    def __init__(self, config: Dict[str, Any]):
+        self.config = config
+        # session_id -> {"cache": OrderedDict[key -> (compressed, digest)],
+        #                "window": [(message_key, role, digest)], "rolling": deque[(role, digest)]}
+        self._sessions: OrderedDict[str, Dict[str, Any]] = OrderedDict()
+
+    @classmethod
+    def _collapse_code(cls, text: str) -> str:
+        def repl(m):
+            body = m.group(2).rstrip("\n")
+            lines = body.count("\n") + 1 if body else 0
+            if lines <= cls.CODE_KEEP_LINES:
+                return m.group(0)
+            return f"[code: {m.group(1) or 'text'}, {lines} lines]"
+        return _CODE_BLOCK_RE.sub(repl, text)
+
+    @staticmethod
+    def _head_tail(text: str, max_tokens: int) -> str:
+        """Keep the head and tail of a message so that it fits max_tokens."""
+        tokens = estimate_tokens(text)
+        if max_tokens <= 0 or tokens <= max_tokens:
+            return text
+        # 按该消息自身的字符/token 比例换算可保留的字符数
+        keep = max(int(len(text) * max_tokens / tokens) - 8, 2)
+        head = keep * 2 // 3
+        tail = keep - head
+        omitted = len(text) - head - tail
+        return f"{text[:head]} …[{omitted} chars]… {text[-tail:]}"
+
+    def compress_text(self, text: str, max_tokens: int) -> str:
+        """Collapse code blocks, squeeze whitespace, then head/tail slice to max_tokens."""
+        text = self._collapse_code(str(text))
+        text = _NEWLINES_RE.sub("\n", _BLANK_RE.sub(" ", text)).strip()
+        return self._head_tail(text, max_tokens)
+
+    def fit_text(self, text: str, max_tokens: int) -> str:
+        """Return text unchanged if it fits max_tokens, otherwise compress it.
+
+        Used for the current user input, whose code is what the router has to
+        score, so it is only collapsed when it is over its share of the budget.
+        """
+        if max_tokens <= 0 or estimate_tokens(text) <= max_tokens:
+            return text
+        return self.compress_text(text, max_tokens)
+
+    def _session_state(self, session_id: Optional[str]) -> Optional[Dict[str, Any]]:
+        if not session_id:
+            return None
+        state = self._sessions.get(session_id)
+        if state is None:
+            state = self._sessions[session_id] = {"cache": OrderedDict(), "window": [], "rolling": deque()}
+            while len(self._sessions) > self.SESSIONS_MAX:
+                self._sessions.popitem(last=False)
+        else:
+            self._sessions.move_to_end(session_id)
+        return state
+
+    def _update_rolling(self, state: Dict[str, Any], window: List[tuple]):
+        """Append digest lines of messages that left the window, then trim to the token cap."""
+        current = {key for key, _, _ in window}
+        rolling = state["rolling"]
+        for key, role, digest in state["window"]:
+            if key not in current:
+                rolling.append((role, digest))
+        state["window"] = window
+
+        total = sum(estimate_tokens(digest) + estimate_tokens(role) + 2 for role, digest in rolling)
+        while rolling and total > self.ROLLING_DIGEST_TOKENS:
+            role, digest = rolling.popleft()
+            total -= estimate_tokens(digest) + estimate_tokens(role) + 2
+
+    def _compress_message(self, cache: Optional[OrderedDict], role: str, content: str, max_tokens: int):
+        key = hashlib.md5(f"{role}:{max_tokens}:{content}".encode()).hexdigest()
+        if cache is not None and key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+
+        compressed = self.compress_text(content, max_tokens)
+        digest = self._head_tail(compressed.replace("\n", " "), self.DIGEST_TOKENS)
+        entry = (compressed, digest)
+        if cache is not None:
+            cache[key] = entry
+            while len(cache) > self.ENTRIES_PER_SESSION:
+                cache.popitem(last=False)
+        return entry
+
+    def compress(self, contexts: List[Dict[str, str]], budget: int, session_id: Optional[str] = None) -> List[Dict[str, str]]:
+        """
+        Fit contexts into `budget` tokens, newest first (budget <= 0 means unlimited).
+        A single message is capped at half of the budget.
+        Messages that no longer fit in full are replaced by their digest line,
+        followed by the session's rolling digest of turns that already left the
+        window; once digest lines do not fit either, older entries are dropped.
+        """
+        router_config = self.config.get("router_config", {})
+        max_chars = router_config.get("context_max_chars", 500)
+        state = self._session_state(session_id)
+        cache = state["cache"] if state else None
+
+        if budget <= 0:
+            budget = math.inf
+        entries = []  # (role, compressed, digest)，按时间顺序
+        window = []
+        for msg in contexts:
+            role = msg.get("role", "user")
+            content = str(msg.get("content", ""))
+            if not content:
+                continue
+            # context_max_chars 仍作为单条消息上限 (换算为 token)
+            per_msg = estimate_tokens(content[:max_chars]) if max_chars > 0 else 0
+            if budget != math.inf:
+                # 单条消息最多占上下文预算的一半，给较早的短消息留出空间
+                share = max(budget // 2, 1)
+                per_msg = min(per_msg, share) if per_msg else share
+            compressed, digest = self._compress_message(cache, role, content, per_msg)
+            entries.append((role, compressed, digest))
+            window.append((hashlib.md5(f"{role}:{content}".encode()).hexdigest(), role, digest))
+
+        rolling = []
+        if state:
+            self._update_rolling(state, window)
+            rolling = list(state["rolling"])
+
+        result = []
+        remaining = budget
+        digest_only = False
+        for role, compressed, digest in reversed(entries):
+            overhead = estimate_tokens(role) + 2
+            if not digest_only:
+                cost = estimate_tokens(compressed) + overhead
+                if cost <= remaining:
+                    result.append({"role": role, "content": compressed})
+                    remaining -= cost
+                    continue
+                digest_only = True
+
+            cost = estimate_tokens(digest) + overhead
+            if cost > remaining:
+                break
+            result.append({"role": role, "content": f"(earlier) {digest}"})
+            remaining -= cost
+        else:
+            # 窗口内消息都已放入，再按从新到旧补充滚动摘要
+            for role, digest in reversed(rolling):
+                cost = estimate_tokens(digest) + estimate_tokens(role) + 2
+                if cost > remaining:
+                    break
+                result.append({"role": role, "content": f"(earlier) {digest}"})
+                remaining -= cost
+
+        result.reverse()
+        return result
@@ -0,0 +1,133 @@
+
+import asyncio
+import math
+import random
+import time
+from collections import Counter, deque
+from typing import Any, Awaitable, Callable, Dict, List
+
+from astrbot.api import logger
+
+
+class DebugDigest:
+    """Buffers router debug records and flushes a compact digest in the background.
+
+    `add()` is synchronous and never awaits, so the event path is not blocked by
+    platform sends. A flush happens every `flush_interval` seconds or once
+    `flush_size` records are buffered, but never more often than
+    `min_send_interval` seconds.
+    """
+
+    BUFFER_MAX = 1000  # 发送受阻时最多缓存的记录数，超出丢弃最旧的
+
+    def __init__(self, config: Dict[str, Any], send: Callable[[str], Awaitable[None]]):
+        self.config = config
+        self._send = send
+        self._records: deque = deque(maxlen=self.BUFFER_MAX)
+        self._dropped = 0
+        self._window_start = time.time()
+        self._last_send = 0.0
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def _cfg(self) -> Dict[str, Any]:
+        return self.config.get("debug_digest", {})
+
+    @property
+    def enabled(self) -> bool:
+        return self._cfg().get("enabled", True)
+
+    def add(self, record: Dict[str, Any]):
+        """Buffer one debug record (subject to sampling) and schedule a flush if needed."""
+        sample_rate = self._cfg().get("sample_rate", 100)
+        if sample_rate < 100 and random.random() * 100 >= sample_rate:
+            return
+
+        if len(self._records) == self._records.maxlen:
+            self._dropped += 1
+        self._records.append(record)
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        if len(self._records) >= self._cfg().get("flush_size", 50):
+            self._wake.set()
+
+    async def _run(self):
+        while True:
+            interval = max(float(self._cfg().get("flush_interval", 60)), 1.0)
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+            # 限速：距上次发送不足 min_send_interval 时延后
+            min_gap = float(self._cfg().get("min_send_interval", 10))
+            delay = self._last_send + min_gap - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            if self._records:
+                await self.flush()
+
+    async def flush(self):
+        """Format and send everything buffered so far."""
+        records = list(self._records)
+        self._records.clear()
+        if not records:
+            return
+        dropped, self._dropped = self._dropped, 0
+        elapsed = time.time() - self._window_start
+        self._window_start = time.time()
+        self._last_send = time.time()
+
+        text = self.format_digest(records, elapsed, dropped)
+        try:
+            await self._send(text)
+        except Exception as e:
+            logger.error(f"Failed to send router debug digest: {e}")
+
+    def format_digest(self, records: List[Dict[str, Any]], elapsed: float, dropped: int = 0) -> str:
+        top_n = self._cfg().get("top_n", 3)
+        times = sorted(r["time_ms"] for r in records)
+        p95 = times[max(math.ceil(len(times) * 0.95) - 1, 0)]
+        avg = sum(times) / len(times)
+
+        tiers = Counter(r["tier_name"] for r in records)
+        sources = Counter(r.get("route_source", "router").split(":")[-1] for r in records)
+        cache_rate = (sources.get("cache", 0) + sources.get("exact_cache", 0)) / len(records) * 100
+
+        header = f"[🧩 Model Router Digest] {len(records)} msgs / {elapsed:.0f}s"
+        if dropped:
+            header += f" ({dropped} dropped)"
+        lines = [
+            header,
+            "🎚️ Tiers: " + " | ".join(f"{t} {tiers.get(t, 0)}" for t in ("low", "mid", "high")),
+            f"⏱️ Router: avg {avg:.1f}ms | p95 {p95:.1f}ms",
+            f"💾 Cache hit: {cache_rate:.1f}%",
+            "🔀 Sources: " + " | ".join(f"{k} {v}" for k, v in sources.most_common()),
+        ]
+
+        slowest = sorted(records, key=lambda r: r["time_ms"], reverse=True)[:top_n]
+        if slowest:
+            lines.append(f"🐢 Slowest {len(slowest)}:")
+            for i, r in enumerate(slowest, 1):
+                reasoning = str(r.get("reasoning", ""))
+                if len(reasoning) > 80:
+                    reasoning = reasoning[:80] + "..."
+                lines.append(
+                    f" {i}. {r['time_ms']:.1f}ms {r['category']} "
+                    f"(Score {r['final_score']} | {r['tier_name']}) -> {r['model_display']}: {reasoning}"
+                )
+        return "\n".join(lines)
+
+    async def stop(self):
+        """Cancel the background loop and flush what is left."""
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        await self.flush()
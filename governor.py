@@ -0,0 +1,153 @@
+
+import asyncio
+import time
+from typing import Dict, Any, Optional, Tuple
+
+from astrbot.api import logger
+
+
+class TokenBucket:
+    """Token bucket that allows reservations to go into debt.
+
+    A reservation always takes one token; if the balance drops below zero the
+    caller must wait until the debt has been refilled. This keeps waiters in
+    FIFO order without a polling loop.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+
+    def reserve(self, now: float) -> float:
+        """Take one token and return how long the caller has to wait (seconds)."""
+        self._refill(now)
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def refund(self):
+        """Give back a token from a reservation that was not used."""
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def available(self, now: float) -> float:
+        self._refill(now)
+        return self.tokens
+
+    def is_idle(self, now: float) -> bool:
+        """Bucket is full again, so dropping it loses no state."""
+        return self.available(now) >= self.capacity
+
+
+class RouterGovernor:
+    """Rate governor for router model calls (global + per-session).
+
+    Callers that cannot get a token within `max_wait_ms`, or that would push
+    the wait queue past `max_queue`, are rejected so the router can degrade
+    instead of piling up latency.
+    """
+
+    SESSION_BUCKETS_MAX = 500  # 超过后清理空闲的会话桶
+
+    def __init__(self, config: Dict[str, Any]):
+        self.config = config
+        self._global_bucket: Optional[TokenBucket] = None
+        self._global_params: Optional[Tuple[float, float]] = None
+        self._session_buckets: Dict[str, TokenBucket] = {}
+        self._session_params: Optional[Tuple[float, float]] = None
+        self._waiting = 0
+        self.rejected = 0
+
+    def _cfg(self) -> Dict[str, Any]:
+        return self.config.get("rate_control", {})
+
+    @property
+    def enabled(self) -> bool:
+        return self._cfg().get("enabled", False)
+
+    def _get_global_bucket(self) -> Optional[TokenBucket]:
+        cfg = self._cfg()
+        params = (float(cfg.get("global_rate", 5)), float(cfg.get("global_burst", 10)))
+        if params[0] <= 0:
+            return None
+        # 配置变更时重建
+        if self._global_bucket is None or self._global_params != params:
+            self._global_bucket = TokenBucket(*params)
+            self._global_params = params
+        return self._global_bucket
+
+    def _get_session_bucket(self, session_id: Optional[str], now: float) -> Optional[TokenBucket]:
+        if not session_id:
+            return None
+        cfg = self._cfg()
+        params = (float(cfg.get("session_rate", 0.5)), float(cfg.get("session_burst", 3)))
+        if params[0] <= 0:
+            return None
+        if self._session_params != params:
+            self._session_buckets.clear()
+            self._session_params = params
+
+        bucket = self._session_buckets.get(session_id)
+        if bucket is None:
+            if len(self._session_buckets) >= self.SESSION_BUCKETS_MAX:
+                for sid in [s for s, b in self._session_buckets.items() if b.is_idle(now)]:
+                    del self._session_buckets[sid]
+            bucket = TokenBucket(*params)
+            self._session_buckets[session_id] = bucket
+        return bucket
+
+    async def acquire(self, session_id: Optional[str] = None) -> bool:
+        """Wait for a router call slot. Returns False if the budget is exhausted."""
+        if not self.enabled:
+            return True
+
+        cfg = self._cfg()
+        max_queue = int(cfg.get("max_queue", 20))
+        max_wait = float(cfg.get("max_wait_ms", 3000)) / 1000
+
+        now = time.monotonic()
+        buckets = [b for b in (self._get_global_bucket(), self._get_session_bucket(session_id, now)) if b]
+        if not buckets:
+            return True
+
+        wait = max(b.reserve(now) for b in buckets)
+        if wait <= 0:
+            return True
+
+        if wait > max_wait or self._waiting >= max_queue:
+            for b in buckets:
+                b.refund()
+            self.rejected += 1
+            logger.debug(f"🚦 Router governor: rejected (wait {wait * 1000:.0f}ms, queue {self._waiting}/{max_queue})")
+            return False
+
+        self._waiting += 1
+        try:
+            await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            # 被取消的等待者 (如被新消息取代) 归还预订的令牌
+            for b in buckets:
+                b.refund()
+            raise
+        finally:
+            self._waiting -= 1
+        return True
+
+    def status(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        bucket = self._get_global_bucket()
+        return {
+            "enabled": self.enabled,
+            "global_tokens": bucket.available(now) if bucket else None,
+            "waiting": self._waiting,
+            "rejected": self.rejected,
+            "sessions": len(self._session_buckets),
+        }
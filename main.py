@@ -1,11 +1,16 @@
 
+import asyncio
 import json
+import os
+import re
 import time
 from astrbot.api.all import *
 from astrbot.api.event import filter
 from astrbot.api.event.filter import after_message_sent
 from astrbot.core.provider.entities import ProviderRequest
 
+from .debug_digest import DebugDigest
+from .profiler import RoutingProfiler
 from .routing import IntentRouter
 
 @register(
@@ -20,7 +25,25 @@ class ModelRouterPlugin(Star):
         super().__init__(context)
         self.config = config
         self.router = IntentRouter(context, config)
+        self.debug_digest = DebugDigest(config, self._send_debug_text)
+        self.profiler = RoutingProfiler(self.router, self._get_data_dir(), self._send_text)
         self.task_snapshots = {}  # {session_id: {task_id: {score, category, summary, time}}}
+        # {session_id: {gen, written, inflight, pending, decision}}
+        # gen: 按到达顺序的消息序号; written: 最近完成写回的序号 (快照写回按二者排序，旧结果丢弃);
+        # inflight: 进行中的消息数; pending: 进行中的路由分析任务 (latest-wins);
+        # decision: 最新消息的路由结果 Future，被取代的消息等待并复用它
+        # 快照的读取/老化与写回之间没有 await，无需加锁
+        self._sessions = {}
+
+    @staticmethod
+    def _get_data_dir() -> str:
+        """插件数据目录 (用于保存性能分析报告)"""
+        try:
+            from astrbot.api.star import StarTools
+            return str(StarTools.get_data_dir("astrbot_plugin_model_router"))
+        except Exception:
+            # 旧版本 AstrBot 没有 StarTools.get_data_dir
+            return os.path.join("data", "plugin_data", "astrbot_plugin_model_router")
 
     @filter.event_message_type(filter.EventMessageType.ALL, priority=9999)
     async def pre_route_message(self, event: AstrMessageEvent):
@@ -61,6 +84,24 @@ class ModelRouterPlugin(Star):
                 return
         
         # 2. Analyze Intent (using message_str since we don't have ProviderRequest yet)
+        profiling = self.profiler.active
+        prof_token = self.profiler.enter() if profiling else None
+
+        # === 同会话状态：按到达顺序分配序号 (在任何 await 之前) ===
+        latest_wins = self.config.get("router_config", {}).get("latest_wins", False)
+        state = self._sessions.get(sid)
+        if state is None:
+            state = self._sessions[sid] = {"gen": 0, "written": 0, "inflight": 0, "pending": None, "decision": None}
+        state["gen"] += 1
+        state["inflight"] += 1
+        gen = state["gen"]
+        decision = state["decision"] = asyncio.get_event_loop().create_future()
+        if latest_wins:
+            pending = state["pending"]
+            if pending and not pending.done():
+                pending.cancel()
+                logger.debug(f"⏭️ Router: Superseding pending analysis for {sid}")
+
         try:
             start_time = time.time()
             
@@ -77,36 +118,38 @@ class ModelRouterPlugin(Star):
                 if cid:
                     conv = await conv_mgr.get_conversation(umo, cid)
                     if conv and conv.messages:
-                        # Get max chars setting (0 = no truncation)
-                        max_chars = self.config.get("router_config", {}).get("context_max_chars", 500)
                         # Get last few messages for context
-                        for msg in conv.messages[-6:]:
-                            content = str(msg.content)
-                            if max_chars > 0:
-                                content = content[:max_chars]
-                            contexts.append({"role": msg.role, "content": content})
+                        # 截断与压缩由 IntentRouter 按 token 预算统一处理
+                        context_turns = self.config.get("router_config", {}).get("context_turns", 4)
+                        if context_turns > 0:
+                            for msg in conv.messages[-context_turns * 2:]:
+                                contexts.append({"role": msg.role, "content": str(msg.content)})
             except Exception as e:
                 logger.debug(f"Could not get conversation context: {e}")
             
             # === 获取任务快照 ===
-            sid = event.unified_msg_origin
-            session_snapshots = self.task_snapshots.get(sid, {})
-            
-            # 获取配置的上下文轮数
-            context_turns = self.config.get("router_config", {}).get("context_turns", 4)
-            
-            # 清理过期快照 (基于轮数，而非时间)
-            # 每个快照有 turn_count，每次对话后递增
-            # 当 turn_count 超过 context_turns 时过期
-            valid_snapshots = {}
-            for task_id, snap in session_snapshots.items():
-                snap["turn_count"] = snap.get("turn_count", 0) + 1
-                if snap["turn_count"] <= context_turns:
-                    valid_snapshots[task_id] = snap
-                else:
-                    logger.debug(f"📤 Snapshot expired: {task_id} (turn {snap['turn_count']} > {context_turns})")
-            self.task_snapshots[sid] = valid_snapshots
-            
+            # 获取上下文期间已有更新的消息到达：不再调用路由模型，也不推进快照
+            superseded = latest_wins and state["gen"] != gen
+            valid_snapshots = self.task_snapshots.get(sid, {})
+
+            if not superseded:
+                session_snapshots = valid_snapshots
+
+                # 获取配置的上下文轮数
+                context_turns = self.config.get("router_config", {}).get("context_turns", 4)
+
+                # 清理过期快照 (基于轮数，而非时间)
+                # 每个快照有 turn_count，每次对话后递增
+                # 当 turn_count 超过 context_turns 时过期
+                valid_snapshots = {}
+                for task_id, snap in session_snapshots.items():
+                    snap["turn_count"] = snap.get("turn_count", 0) + 1
+                    if snap["turn_count"] <= context_turns:
+                        valid_snapshots[task_id] = snap
+                    else:
+                        logger.debug(f"📤 Snapshot expired: {task_id} (turn {snap['turn_count']} > {context_turns})")
+                self.task_snapshots[sid] = valid_snapshots
+
             # 构建快照列表供路由器使用
             snapshot_list = []
             for task_id, snap in valid_snapshots.items():
@@ -117,8 +160,16 @@ class ModelRouterPlugin(Star):
                     "summary": snap.get("summary", "")[:100]
                 })
 
-            logger.info(f"🧩 Router analyzing: '{user_text[:30]}...' (Active snapshots: {len(snapshot_list)})")
-            analysis = await self.router.analyze_intent(user_text, contexts, task_snapshots=snapshot_list)
+            if superseded:
+                analysis = await self._reuse_newer_decision(state, sid, user_text, contexts)
+            else:
+                logger.info(f"🧩 Router analyzing: '{user_text[:30]}...' (Active snapshots: {len(snapshot_list)})")
+                analysis, superseded = await self._run_analysis(state, sid, user_text, contexts, snapshot_list, latest_wins)
+            if not decision.done():
+                decision.set_result(analysis)
+
+            if superseded:
+                logger.info(f"⏭️ Router: Superseded by newer message, using: {analysis['route_source']}")
             
             end_time = time.time()
             router_time_ms = (end_time - start_time) * 1000
@@ -134,6 +185,9 @@ class ModelRouterPlugin(Star):
             reasoning = analysis.get("reasoning", "")
             context_relation = analysis.get("context_relation", "unrelated")
             continued_task_id = analysis.get("continued_task_id")
+            route_source = analysis.get("route_source", "router")
+            if superseded:
+                route_source = f"superseded:{route_source}"
             
             # === 根据 context_relation 决定最终分数 ===
             final_score = ai_score
@@ -157,21 +211,28 @@ class ModelRouterPlugin(Star):
                 logger.info(f"🆕 Context UNRELATED: Independent score {final_score}")
             
             # === 更新快照 (仅当 score >= 4 且非纯闲聊) ===
-            if final_score >= 4:
-                # 生成新的 task_id
-                task_id = f"task_{int(time.time()) % 10000}"
-                # 从用户输入生成简短摘要
-                summary = user_text[:50] + ("..." if len(user_text) > 50 else "")
-                
-                valid_snapshots[task_id] = {
-                    "score": final_score,
-                    "category": category,
-                    "summary": summary,
-                    "turn_count": 0  # 新快照从 0 开始计数
-                }
-                self.task_snapshots[sid] = valid_snapshots
-                logger.debug(f"📸 Snapshot saved: {task_id} (Score {final_score}, Cat: {category})")
-            # 注意：低分闲聊不更新快照，保留之前的高难度任务记录
+            # 只有路由模型的真实决策 (含正常缓存命中) 才写快照；降级/被取代的决策是猜测或
+            # 复用，写入后会作为伪任务出现在后续 Prompt 中并通过 continue 锁定分数
+            if gen < state["written"]:
+                # 更新的消息已先完成写回，丢弃乱序到达的旧结果
+                logger.debug(f"📸 Snapshot write discarded: message {gen} finished after {state['written']}")
+            else:
+                state["written"] = gen
+                if final_score >= 4 and route_source in ("router", "cache"):
+                    # 生成新的 task_id
+                    task_id = f"task_{int(time.time()) % 10000}"
+                    # 从用户输入生成简短摘要
+                    summary = user_text[:50] + ("..." if len(user_text) > 50 else "")
+                    
+                    session_snapshots = self.task_snapshots.setdefault(sid, {})
+                    session_snapshots[task_id] = {
+                        "score": final_score,
+                        "category": category,
+                        "summary": summary,
+                        "turn_count": 0  # 新快照从 0 开始计数
+                    }
+                    logger.debug(f"📸 Snapshot saved: {task_id} (Score {final_score}, Cat: {category})")
+                # 注意：低分闲聊不更新快照，保留之前的高难度任务记录
             
             # 3. Get Target Provider/Model
             t_provider_id, t_model_name, t_tier_name = self.get_target_config(category, final_score)
@@ -211,6 +272,7 @@ class ModelRouterPlugin(Star):
                     "context_relation": context_relation,
                     "continued_task_id": continued_task_id,
                     "score_source": score_source,
+                    "route_source": route_source,
                     "active_snapshots": len(valid_snapshots),
                     "reasoning": reasoning,
                     "origin_sid": event.unified_msg_origin
@@ -222,10 +284,60 @@ class ModelRouterPlugin(Star):
             logger.error(f"Router error in pre_route_message: {e}")
             import traceback
             logger.error(traceback.format_exc())
+        finally:
+            # 未产生决策 (提前返回/异常) 时也要结束 Future，避免被取代的旧消息一直等待
+            if not decision.done():
+                decision.set_result(None)
+            # 该会话没有进行中的消息时释放其状态
+            state["inflight"] -= 1
+            if state["inflight"] == 0 and self._sessions.get(sid) is state:
+                del self._sessions[sid]
+            if profiling:
+                self.profiler.exit("pre_route_message", prof_token)
+
+    async def _run_analysis(self, state: dict, sid: str, user_text: str, contexts: list, snapshot_list: list, latest_wins: bool):
+        """
+        Run router analysis for a session.
+        In latest-wins mode the call is tracked so a newer message can cancel it;
+        a cancelled analysis reuses the newer message's decision instead of finishing.
+        Returns (analysis, superseded).
+        """
+        if not latest_wins:
+            analysis = await self.router.analyze_intent(user_text, contexts, task_snapshots=snapshot_list, session_id=sid)
+            return analysis, False
+
+        task = asyncio.ensure_future(
+            self.router.analyze_intent(user_text, contexts, task_snapshots=snapshot_list, session_id=sid)
+        )
+        state["pending"] = task
+        try:
+            # asyncio.wait 不会因内部任务被取消而抛出，便于区分"被新消息取代"和"自身被取消"
+            await asyncio.wait({task})
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            if state["pending"] is task:
+                state["pending"] = None
+
+        if task.cancelled():
+            return await self._reuse_newer_decision(state, sid, user_text, contexts), True
+        return task.result(), False
+
+    async def _reuse_newer_decision(self, state: dict, sid: str, user_text: str, contexts: list):
+        """
+        Wait for the decision of the newest message in the session and reuse it.
+        Falls back to router.degrade() if that message produced no decision.
+        """
+        # shield: 本消息被取消时不能连带取消较新消息的 Future
+        analysis = await asyncio.shield(state["decision"])
+        if analysis:
+            return dict(analysis)
+        return self.router.degrade(user_text, contexts, sid, overload=False)
 
     @after_message_sent()
     async def on_after_message_sent(self, event: AstrMessageEvent):
-        """消息发送后，创建并发送 debug 信息到指定 SID"""
+        """消息发送后，将 debug 信息交给摘要聚合器或直接发送到指定 SID"""
         debug_data = event.get_extra("_router_debug_data")
         if not debug_data:
             return
@@ -244,6 +356,11 @@ class ModelRouterPlugin(Star):
             logger.info(f"[Router Debug] {debug_data}")
             return
         
+        # 摘要模式：仅缓存记录，由后台任务定期汇总发送，不阻塞事件链路
+        if self.debug_digest.enabled:
+            self.debug_digest.add(debug_data)
+            return
+        
         # 格式化 debug 消息 (新增 context_relation 等字段)
         context_info = f"📋 Context: {debug_data['context_relation']}"
         if debug_data['continued_task_id']:
@@ -253,28 +370,48 @@ class ModelRouterPlugin(Star):
         if debug_data['ai_score'] != debug_data['final_score']:
             score_info = f"Score {debug_data['ai_score']}→{debug_data['final_score']}"
         
+        router_info = f"🤖 Router: {debug_data['router_model']}"
+        if debug_data.get('route_source', 'router') != 'router':
+            router_info += f" (via {debug_data['route_source']})"
+        
         debug_msg = (
             f"[🧩 Model Router Debug]\n"
             f"⏱️ Time: {debug_data['time_ms']:.1f}ms\n"
-            f"🤖 Router: {debug_data['router_model']}\n"
+            f"{router_info}\n"
             f"{context_info} (Snapshots: {debug_data['active_snapshots']})\n"
             f"🎯 Target: {debug_data['category']} ({score_info} | {debug_data['tier_name']}) -> {debug_data['model_display']}\n"
             f"💡 Reasoning: {debug_data['reasoning']}"
         )
         
-        # 发送到指定 SID
+        await self._send_debug_text(debug_msg)
+
+    async def _send_debug_text(self, text: str):
+        """发送 debug 文本到配置的 debug_target_sid"""
+        debug_target_sid = self.config.get("router_config", {}).get("debug_target_sid", "")
+        if not debug_target_sid:
+            logger.info(text)
+            return
+        await self._send_text(debug_target_sid, text)
+
+    async def _send_text(self, sid: str, text: str):
+        """主动发送纯文本消息到指定 SID"""
         try:
             from astrbot.core.message.components import Plain
             from astrbot.core.message.message_event_result import MessageChain
             
             message_chain = MessageChain()
-            message_chain.chain.append(Plain(debug_msg))
+            message_chain.chain.append(Plain(text))
             
-            success = await self.context.send_message(debug_target_sid, message_chain)
+            success = await self.context.send_message(sid, message_chain)
             if not success:
-                logger.warning(f"Failed to find platform for debug SID: {debug_target_sid}")
+                logger.warning(f"Failed to find platform for SID: {sid}")
         except Exception as e:
-            logger.error(f"Failed to send debug to {debug_target_sid}: {e}")
+            logger.error(f"Failed to send message to {sid}: {e}")
+
+    async def terminate(self):
+        """插件卸载/停用时，发送剩余的 debug 摘要并结束性能采样"""
+        await self.debug_digest.stop()
+        await self.profiler.stop()
 
         
     def get_target_config(self, category: str, difficulty: int):
@@ -370,6 +507,7 @@ class ModelRouterPlugin(Star):
                 "/router config - 显示当前路由配置\n"
                 "/router debug - 切换调试模式\n"
                 "/router status - 查看路由器状态\n"
+                "/router profile [秒数|N msg|stop] - 采样路由性能\n"
                 "/router list - 显示黑白名单\n"
                 "/router add [sid] - 添加会话到名单\n"
                 "/router remove [sid] - 从名单移除会话"
@@ -415,14 +553,62 @@ class ModelRouterPlugin(Star):
             router_provider = self.config.get("router_config", {}).get("router_provider", "Not set")
             router_model = self.config.get("router_config", {}).get("router_model", "Not set")
             
+            gov = self.router.governor.status()
+            if gov["enabled"]:
+                tokens = "∞" if gov["global_tokens"] is None else f"{gov['global_tokens']:.1f}"
+                gov_info = f"On (tokens {tokens}, waiting {gov['waiting']}, rejected {gov['rejected']})"
+            else:
+                gov_info = "Off"
+            level = self.router.degrade_level
+            level_age = int(time.time() - self.router.degrade_since)
+            counts = self.router.source_counts
+            sources = " / ".join(
+                f"{k} {counts.get(k, 0)}" for k in ("router", "cache", "exact_cache", "similar", "heuristic", "default")
+            )
+            
             return event.plain_result(
                 f"🧩 Model Router Status:\n"
                 f"- Enabled: {'Yes' if enabled else 'No'}\n"
                 f"- Debug: {'On' if debug else 'Off'}\n"
                 f"- Router LLM: {router_provider}:{router_model}\n"
+                f"- Rate Governor: {gov_info}\n"
+                f"- Degradation: {level} (for {level_age}s)\n"
+                f"- Decisions: {sources}\n"
                 f"- Version: 0.5.1"
             )
         
+        elif sub_cmd == "profile":
+            usage = "Usage: /router profile <seconds> | /router profile <N> msg | /router profile stop"
+            if len(args) < 3:
+                state = "running" if self.profiler.active else "idle"
+                return event.plain_result(f"🔬 Profiler: {state}\n{usage}")
+            
+            param = args[2].lower()
+            if param == "stop":
+                if not self.profiler.active:
+                    return event.plain_result("🔬 Profiler is not running.")
+                summary = await self.profiler.stop(event.unified_msg_origin)
+                result = event.plain_result(summary or "🔬 Profiler is not running.")
+                result.use_t2i(False)
+                return result
+            
+            # "30" / "30s" -> 秒数；"50 msg" / "50msg" / "50 messages" -> 消息数
+            match = re.fullmatch(r"(\d+)\s*(s|sec|msg|msgs|messages)?", " ".join(args[2:4]).lower())
+            if not match or int(match.group(1)) <= 0:
+                return event.plain_result(usage)
+            count = int(match.group(1))
+            by_messages = (match.group(2) or "").startswith(("msg", "message"))
+            
+            if by_messages:
+                error = self.profiler.start(event.unified_msg_origin, messages=count)
+                window = f"{count} messages (max {RoutingProfiler.MAX_SECONDS}s)"
+            else:
+                error = self.profiler.start(event.unified_msg_origin, seconds=count)
+                window = f"{min(count, RoutingProfiler.MAX_SECONDS)}s"
+            if error:
+                return event.plain_result(f"⚠️ {error}")
+            return event.plain_result(f"🔬 Profiling routing for {window}. A summary will be sent here when done.")
+        
         elif sub_cmd == "list":
             session_cfg = self.config.get("session_control", {})
             filter_type = session_cfg.get("filter_type", "blacklist")
@@ -0,0 +1,281 @@
+
+import asyncio
+import concurrent.futures
+import cProfile
+import io
+import math
+import os
+import pstats
+import re
+import threading
+import time
+import tracemalloc
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from astrbot.api import logger
+
+_PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+# 事件循环的帧 (select/epoll 等待、asyncio 调度)，统计插件调用链时不向下展开
+_LOOP_FRAMES_RE = re.compile(
+    r"[/\\]asyncio[/\\]|selectors\.py|'select\.|built-in method select\.|_lsprof\.|'_contextvars\.|'_asyncio\."
+)
+
+
+class RoutingProfiler:
+    """
+    On-demand cProfile + tracemalloc sampling of the routing pipeline.
+
+    cProfile is enabled only while a pre_route_message / analyze_intent call is
+    in flight during the window. It still sees every coroutine the loop runs
+    in that time, so the report keeps only this plugin's functions and what
+    they call, and only allocations with a plugin frame in their traceback. When no window is open the only cost on the
+    hot path is reading `active`; analyze_intent is wrapped by patching the
+    router instance for the duration of the window and restored afterwards.
+    """
+
+    MAX_SECONDS = 600  # 单次采样窗口上限 (消息数模式同样受此限制)
+    TOP_N = 25
+
+    def __init__(self, router, data_dir: str, notify: Callable[[str, str], Awaitable[None]]):
+        self.router = router
+        self.data_dir = data_dir
+        self._notify = notify  # (session_id, text) -> 发送结果摘要
+        self.active = False
+        self._profile: Optional[cProfile.Profile] = None
+        self._depth = 0
+        self._timings: Dict[str, List[float]] = {}
+        self._messages = 0
+        self._max_messages = 0
+        self._started = 0.0
+        self._owns_tracemalloc = False
+        self._finishing = False  # 报告仍在线程池中生成
+        self._mem_start = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._reply_sid = ""
+        self._window = 0  # 采样窗口序号，忽略跨窗口的迟到调用
+
+    def start(self, reply_sid: str, seconds: Optional[float] = None, messages: Optional[int] = None) -> Optional[str]:
+        """Open a sampling window. Returns an error message, or None on success."""
+        if self.active:
+            return "Profiler is already running."
+        if self._finishing:
+            return "Previous profile report is still being written."
+
+        profile = cProfile.Profile()
+        try:
+            # 其他性能分析工具已占用时 (Python 3.12+) 会在这里失败
+            profile.enable()
+            profile.disable()
+        except ValueError as e:
+            return f"Cannot start cProfile: {e}"
+
+        self._profile = profile
+        self._window += 1
+        self._depth = 0
+        self._timings = {"pre_route_message": [], "analyze_intent": []}
+        self._messages = 0
+        self._max_messages = messages or 0
+        self._reply_sid = reply_sid
+        self._started = time.time()
+
+        self._owns_tracemalloc = not tracemalloc.is_tracing()
+        if self._owns_tracemalloc:
+            tracemalloc.start(10)
+        self._mem_start = tracemalloc.take_snapshot()
+
+        window = min(seconds or self.MAX_SECONDS, self.MAX_SECONDS)
+        self._timer = asyncio.get_event_loop().call_later(window, lambda: asyncio.ensure_future(self.stop()))
+        self._patch_router()
+        self.active = True
+        logger.info(f"🔬 Router profiler started ({f'{messages} messages' if messages else f'{window:.0f}s'})")
+        return None
+
+    def _patch_router(self):
+        original = type(self.router).analyze_intent.__get__(self.router)
+
+        async def analyze_intent(*args, **kwargs):
+            start = self.enter()
+            try:
+                return await original(*args, **kwargs)
+            finally:
+                self.exit("analyze_intent", start)
+
+        self.router.analyze_intent = analyze_intent
+
+    def _unpatch_router(self):
+        self.router.__dict__.pop("analyze_intent", None)
+
+    def enter(self) -> tuple:
+        """Mark the start of a profiled call; cProfile runs while any call is in flight."""
+        if self._depth == 0 and self._profile:
+            self._profile.enable()
+        self._depth += 1
+        return self._window, time.perf_counter()
+
+    def exit(self, name: str, token: tuple):
+        window, start = token
+        if not self.active or window != self._window:
+            return
+        self._depth -= 1
+        if self._depth == 0 and self._profile:
+            self._profile.disable()
+        self._timings.setdefault(name, []).append((time.perf_counter() - start) * 1000)
+
+        if name == "pre_route_message":
+            self._messages += 1
+            if self._max_messages and self._messages >= self._max_messages:
+                asyncio.ensure_future(self.stop())
+
+    async def stop(self, caller_sid: Optional[str] = None) -> Optional[str]:
+        """
+        Close the window and build the report in a worker thread. Returns the
+        summary; it is also sent to the session that started the window unless
+        that session is the caller.
+        """
+        if not self.active:
+            return None
+        self.active = False
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self._unpatch_router()
+        if self._depth > 0 and self._profile:
+            self._profile.disable()
+        self._depth = 0
+
+        # 快照对比、pstats 排序与写文件都较慢，放到线程池里执行，避免阻塞事件循环
+        args = (self._profile, self._mem_start, self._timings, self._messages,
+                time.time() - self._started, self._owns_tracemalloc)
+        self._profile = None
+        self._mem_start = None
+        self._finishing = True
+        try:
+            summary = await asyncio.get_event_loop().run_in_executor(None, self._finish, *args)
+        finally:
+            self._finishing = False
+
+        if caller_sid != self._reply_sid:
+            try:
+                await self._notify(self._reply_sid, summary)
+            except Exception as e:
+                logger.error(f"Failed to send router profile summary: {e}")
+        return summary
+
+    def _finish(self, profile, mem_start, timings, messages: int, elapsed: float, owns_tracemalloc: bool) -> str:
+        """Runs in a worker thread: snapshot, build the report, write it and return the summary."""
+        mem_end = tracemalloc.take_snapshot()
+        if owns_tracemalloc:
+            tracemalloc.stop()
+        report, summary = self._build_report(profile, mem_start, mem_end, timings, messages, elapsed)
+
+        path = None
+        try:
+            os.makedirs(self.data_dir, exist_ok=True)
+            path = os.path.join(self.data_dir, f"profile_{time.strftime('%Y%m%d_%H%M%S')}.txt")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(report)
+            summary += f"\n📄 Report: {path}"
+        except Exception as e:
+            logger.error(f"Failed to write router profile report: {e}")
+            summary += f"\n⚠️ Report not saved: {e}"
+
+        logger.info(f"🔬 Router profiler finished: {path}")
+        return summary
+
+    @staticmethod
+    def _timing_line(name: str, values: List[float]) -> str:
+        if not values:
+            return f"{name}: no calls"
+        values = sorted(values)
+        p95 = values[max(math.ceil(len(values) * 0.95) - 1, 0)]
+        return (
+            f"{name}: {len(values)} calls, avg {sum(values) / len(values):.1f}ms, "
+            f"p95 {p95:.1f}ms, max {values[-1]:.1f}ms"
+        )
+
+    @staticmethod
+    def _plugin_stats(stats: pstats.Stats) -> pstats.Stats:
+        """Keep only this plugin's functions and their callees (via pstats caller data)."""
+        callees: Dict[tuple, List[tuple]] = {}
+        for func, (_, _, _, _, callers) in stats.stats.items():
+            for caller in callers:
+                callees.setdefault(caller, []).append(func)
+
+        own_file = os.path.abspath(__file__)
+        pending = [
+            func for func in stats.stats
+            if os.path.dirname(os.path.abspath(func[0])) == _PLUGIN_DIR and os.path.abspath(func[0]) != own_file
+        ]
+        keep, seen = set(), set()
+        while pending:
+            func = pending.pop()
+            if func in seen or _LOOP_FRAMES_RE.search(pstats.func_std_string(func)):
+                continue
+            seen.add(func)
+            # 本模块的包装函数不计入，但继续展开其调用
+            if os.path.abspath(func[0]) != own_file:
+                keep.add(func)
+            pending.extend(callees.get(func, ()))
+
+        stats.stats = {func: stat for func, stat in stats.stats.items() if func in keep}
+        stats.prim_calls = sum(stat[0] for stat in stats.stats.values())
+        stats.total_calls = sum(stat[1] for stat in stats.stats.values())
+        stats.total_tt = sum(stat[2] for stat in stats.stats.values())
+        return stats
+
+    def _build_report(self, profile, mem_start, mem_end, timings, messages: int, elapsed: float) -> tuple:
+        timing_lines = [self._timing_line(name, values) for name, values in timings.items()]
+
+        stats_io = io.StringIO()
+        top_funcs = []
+        stats = self._plugin_stats(pstats.Stats(profile, stream=stats_io))
+        stats.sort_stats("cumulative").print_stats(self.TOP_N)
+        stats_io.write("\n")
+        stats.sort_stats("tottime").print_stats(self.TOP_N)
+        for (filename, lineno, func), (_, _, tottime, _, _) in sorted(
+            stats.stats.items(), key=lambda item: item[1][2], reverse=True
+        )[:3]:
+            top_funcs.append(f"{func} ({os.path.basename(filename)}:{lineno}) {tottime * 1000:.1f}ms")
+
+        ignore = (
+            # 只统计调用栈中经过本插件的分配
+            tracemalloc.Filter(True, os.path.join(_PLUGIN_DIR, "*"), all_frames=True),
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, os.path.join(os.path.dirname(asyncio.__file__), "*")),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+            # 报告在线程池中生成，线程池自身的分配不计入
+            tracemalloc.Filter(False, threading.__file__),
+            tracemalloc.Filter(False, os.path.join(os.path.dirname(concurrent.futures.__file__), "*")),
+            tracemalloc.Filter(False, "<unknown>"),
+        )
+        mem_diff = mem_end.filter_traces(ignore).compare_to(mem_start.filter_traces(ignore), "lineno")
+        mem_lines = [str(stat) for stat in mem_diff[:self.TOP_N]]
+        top_allocs = []
+        for stat in mem_diff[:3]:
+            frame = stat.traceback[0]
+            top_allocs.append(f"{os.path.basename(frame.filename)}:{frame.lineno} {stat.size_diff / 1024:+.1f}KiB")
+
+        report = "\n".join([
+            f"Model Router profile - {time.strftime('%Y-%m-%d %H:%M:%S')}",
+            f"Window: {elapsed:.1f}s, messages: {messages}",
+            "",
+            "=== Pipeline timings ===",
+            *timing_lines,
+            "",
+            "=== Top functions (cProfile, plugin code and its callees) ===",
+            stats_io.getvalue(),
+            "=== Top allocations (tracemalloc, growth during window) ===",
+            *mem_lines,
+            "",
+        ])
+
+        summary_lines = [
+            f"🔬 Router profile: {elapsed:.0f}s, {messages} messages",
+            *[f"⏱️ {line}" for line in timing_lines],
+        ]
+        if top_funcs:
+            summary_lines.append("🔥 Top CPU (plugin): " + "; ".join(top_funcs))
+        if top_allocs:
+            summary_lines.append("🧠 Top alloc: " + "; ".join(top_allocs))
+        return report, "\n".join(summary_lines)
@@ -1,52 +1,208 @@
 
 import json
 import hashlib
+import re
 import time
 from typing import Dict, Any, Optional, List
-from collections import OrderedDict
+from collections import OrderedDict, Counter, deque
 
 from astrbot.api.star import Context
 from astrbot.core.provider import Provider
 from astrbot.api import logger  # Use AstrBot's logger from api
 
+from .compressor import ContextCompressor, estimate_tokens
+from .governor import RouterGovernor
+
+_TOKEN_RE = re.compile(r"[\u4e00-\u9fff]|[a-z0-9_]+")
+# 强代码信号：行首的定义/导入语句 (仅出现关键字的普通句子不算)
+_CODE_LINE_RE = re.compile(
+    r"^\s*(def \w+\s*\(|class \w+\s*(\([^)]*\))?\s*:\s*$|(from [\w.]+ )?import [\w.]+( as \w+)?\s*$"
+    r"|#include\s*[<\"]|function \w+\s*\(|(public|private|static)( \w+)+\s*\(|(const|let|var) \w+\s*=)",
+    re.M,
+)
+# 弱代码信号：以 ; { } 结尾的行，需要多行同时出现
+_CODE_PUNCT_RE = re.compile(r"[;{}]\s*$", re.M)
+# 算式：至少一个数字，且至少一个位于两个操作数之间的运算符
+_MATH_RE = re.compile(r"^(?=.*\d)(?=.*[\d)x]\s*[+\-*/^=%×÷]\s*[\d(x])[\d\s.+\-*/^()=%x×÷]+[?？]?$")
+
+# 降级时各 Tier 对应的代表分数 (与 get_target_config 的分段一致)
+_TIER_DEFAULT_SCORES = {"low": 1, "mid": 4, "high": 7}
+
 class IntentRouter:
     # 缓存配置
     CACHE_MAX_SIZE = 100
     CACHE_TTL_SECONDS = 300  # 5分钟过期
+    CACHE_STALE_SECONDS = 3600  # 过期后仍保留，过载降级时可用的最长时间
+    # 会话相似决策配置
+    SIMILAR_PER_SESSION = 8
+    SIMILAR_SESSIONS_MAX = 500  # 保留近期决策的会话数上限，超出丢弃最早的会话
+    SIMILAR_THRESHOLD = 0.5
     
     def __init__(self, context: Context, config: Dict[str, Any]):
         self.context = context
         self.config = config
         self._cache: OrderedDict[str, tuple] = OrderedDict()  # key -> (result, timestamp)
+        # 仅按输入文本索引 (不含上下文)，只在过载降级时查询
+        self._text_cache: OrderedDict[str, tuple] = OrderedDict()
+        self._recent: Dict[str, deque] = {}  # session_id -> deque[(tokens, result, timestamp)]
+        self.governor = RouterGovernor(config)
+        self.compressor = ContextCompressor(config)
+        # 当前降级等级: normal / exact_cache / similar / heuristic / default
+        self.degrade_level = "normal"
+        self.degrade_since = time.time()
+        # 决策来源计数: router / cache (正常缓存命中) / exact_cache / similar / heuristic / default
+        self.source_counts: Counter = Counter()
 
     def _get_cache_key(self, text: str, contexts: List) -> str:
         """Generate cache key from text and recent context."""
         # 只使用最近2条上下文生成key，避免上下文变化导致缓存失效
         ctx_str = str(contexts[-2:]) if contexts else ""
         return hashlib.md5(f"{text}:{ctx_str}".encode()).hexdigest()
+
+    @staticmethod
+    def _get_text_key(text: str) -> str:
+        """Cache key from the input text alone (used by the overload fallback)."""
+        return hashlib.md5(text.strip().encode()).hexdigest()
     
-    def _get_cached(self, key: str) -> Optional[Dict[str, Any]]:
-        """Get cached result if valid (not expired)."""
-        if key not in self._cache:
+    def _get_cached(self, key: str, stale: bool = False, cache: Optional[OrderedDict] = None) -> Optional[Dict[str, Any]]:
+        """Get cached result if valid (not expired); stale=True also accepts expired entries."""
+        cache = self._cache if cache is None else cache
+        if key not in cache:
             return None
-        result, timestamp = self._cache[key]
-        if time.time() - timestamp > self.CACHE_TTL_SECONDS:
-            # 过期，删除
-            del self._cache[key]
+        result, timestamp = cache[key]
+        age = time.time() - timestamp
+        if age > self.CACHE_STALE_SECONDS:
+            # 过期太久，删除
+            del cache[key]
+            return None
+        if age > self.CACHE_TTL_SECONDS and not stale:
+            # 过期但保留，过载降级时仍可使用
             return None
         # 移动到末尾 (LRU)
-        self._cache.move_to_end(key)
+        cache.move_to_end(key)
         return result
     
-    def _set_cached(self, key: str, result: Dict[str, Any]):
+    def _set_cached(self, key: str, result: Dict[str, Any], cache: Optional[OrderedDict] = None):
         """Store result in cache with LRU eviction."""
-        self._cache[key] = (result, time.time())
-        self._cache.move_to_end(key)
+        cache = self._cache if cache is None else cache
+        cache[key] = (result, time.time())
+        cache.move_to_end(key)
         # 清理超过上限的缓存
-        while len(self._cache) > self.CACHE_MAX_SIZE:
-            self._cache.popitem(last=False)
+        while len(cache) > self.CACHE_MAX_SIZE:
+            cache.popitem(last=False)
+
+    @staticmethod
+    def _tokenize(text: str) -> set:
+        return set(_TOKEN_RE.findall(text.lower()))
+
+    def _remember(self, session_id: Optional[str], text: str, result: Dict[str, Any]):
+        """Keep recent router decisions per session for similarity fallback."""
+        if not session_id:
+            return
+        recent = self._recent.get(session_id)
+        if recent is None:
+            if len(self._recent) >= self.SIMILAR_SESSIONS_MAX:
+                self._recent.pop(next(iter(self._recent)))
+            recent = self._recent[session_id] = deque(maxlen=self.SIMILAR_PER_SESSION)
+        recent.append((self._tokenize(text), result, time.time()))
+
+    def _get_similar(self, session_id: Optional[str], text: str) -> Optional[Dict[str, Any]]:
+        """Find the most similar recent decision in the same session (Jaccard on tokens)."""
+        recent = self._recent.get(session_id) if session_id else None
+        if not recent:
+            return None
+        tokens = self._tokenize(text)
+        if not tokens:
+            return None
+        now = time.time()
+        best, best_sim = None, 0.0
+        for prev_tokens, result, timestamp in recent:
+            if now - timestamp > self.CACHE_TTL_SECONDS or not prev_tokens:
+                continue
+            sim = len(tokens & prev_tokens) / len(tokens | prev_tokens)
+            if sim > best_sim:
+                best, best_sim = result, sim
+        if best_sim < self.SIMILAR_THRESHOLD:
+            return None
+        return {
+            "difficulty_score": best.get("difficulty_score", 1),
+            "category": best.get("category", "chat"),
+            "context_relation": "unrelated",
+            "continued_task_id": None,
+            "reasoning": f"Degraded: similar session decision (sim {best_sim:.2f})",
+        }
+
+    @staticmethod
+    def _heuristic(text: str) -> Optional[Dict[str, Any]]:
+        """Cheap local guess when the router model is unavailable."""
+        stripped = text.strip()
+        if not stripped:
+            return None
+        if "```" in stripped or _CODE_LINE_RE.search(stripped) or len(_CODE_PUNCT_RE.findall(stripped)) >= 2:
+            lines = stripped.count("\n") + 1
+            category, score = "code", (5 if lines > 20 else 3)
+        elif _MATH_RE.match(stripped):
+            category, score = "math", 1
+        elif len(stripped) <= 20:
+            category, score = "chat", 1
+        else:
+            return None
+        return {
+            "difficulty_score": score,
+            "category": category,
+            "context_relation": "unrelated",
+            "continued_task_id": None,
+            "reasoning": "Degraded: heuristic",
+        }
+
+    def _set_level(self, level: str):
+        if level != self.degrade_level:
+            self.degrade_level = level
+            self.degrade_since = time.time()
+
+    def _degraded(self, source: str, overload: bool):
+        self.source_counts[source] += 1
+        if overload:
+            self._set_level(source)
+
+    def degrade(self, user_text: str, contexts: List = None, session_id: Optional[str] = None, overload: bool = True) -> Dict[str, Any]:
+        """
+        Decide without calling the router model.
+        Order: exact cache -> similar session decision -> heuristic -> tier default.
+        The exact cache accepts entries past their TTL and entries for the same
+        text under a different context, which the normal lookup does not.
+        The returned dict carries `route_source` with the level that answered.
+        Only overload (overload=True) moves `degrade_level`; superseded messages do not.
+        """
+        cached = self._get_cached(self._get_cache_key(user_text, contexts or []), stale=True)
+        if cached is None:
+            cached = self._get_cached(self._get_text_key(user_text), stale=True, cache=self._text_cache)
+        if cached is not None:
+            self._degraded("exact_cache", overload)
+            return {**cached, "route_source": "exact_cache"}
 
-    async def analyze_intent(self, user_text: str, contexts: List[Dict[str, str]] = None, task_snapshots: List[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        similar = self._get_similar(session_id, user_text)
+        if similar is not None:
+            self._degraded("similar", overload)
+            return {**similar, "route_source": "similar"}
+
+        heuristic = self._heuristic(user_text)
+        if heuristic is not None:
+            self._degraded("heuristic", overload)
+            return {**heuristic, "route_source": "heuristic"}
+
+        tier = self.config.get("rate_control", {}).get("degrade_tier", "low")
+        self._degraded("default", overload)
+        return {
+            "difficulty_score": _TIER_DEFAULT_SCORES.get(tier, 1),
+            "category": "default",
+            "context_relation": "unrelated",
+            "continued_task_id": None,
+            "reasoning": f"Degraded: {tier} tier default",
+            "route_source": "default",
+        }
+
+    async def analyze_intent(self, user_text: str, contexts: List[Dict[str, str]] = None, task_snapshots: List[Dict[str, Any]] = None, session_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
         """
         Analyze user intent using dynamically built system prompt.
         Now includes task snapshots for multi-task context awareness.
@@ -56,6 +212,10 @@ class IntentRouter:
             user_text: Current user input
             contexts: Recent conversation history
             task_snapshots: List of active task snapshots, each with {id, category, score, summary}
+            session_id: Session for per-session rate limiting and similarity fallback
+        
+        When the rate governor rejects the call, falls back to `degrade()`.
+        The result carries `route_source` (router / cache / exact_cache / similar / heuristic / default).
         """
         if contexts is None:
             contexts = []
@@ -67,7 +227,8 @@ class IntentRouter:
         cached = self._get_cached(cache_key)
         if cached is not None:
             logger.debug(f"Router cache hit for: {user_text[:30]}...")
-            return cached
+            self.source_counts["cache"] += 1
+            return {**cached, "route_source": "cache"}
             
         router_config = self.config.get("router_config", {})
         provider_id = router_config.get("router_provider")
@@ -87,6 +248,14 @@ class IntentRouter:
             logger.error(f"Router provider not found: {provider_id}")
             return None
 
+        # --- 限流：预算耗尽时降级，不构建 Prompt 也不调用路由模型 ---
+        if not await self.governor.acquire(session_id):
+            result = self.degrade(user_text, contexts, session_id)
+            logger.info(f"🚦 Router budget exhausted, degraded to: {result['route_source']}")
+            return result
+        # 限流放行即视为过载结束
+        self._set_level("normal")
+
         # --- Build Dynamic System Prompt from Frames (Fixed Slots) ---
         
         categories_map = {} # name -> list of descriptions
@@ -128,25 +297,30 @@ class IntentRouter:
         t_low = self.config.get("tier_low", {}).get("max_score", 3)
         t_mid = self.config.get("tier_mid", {}).get("max_score", 7)
         
-        # --- Format conversation context ---
+        # --- Compress current input and conversation context to the token budget ---
+        # 总预算由当前输入与上下文共享：当前输入最多占一半，剩余留给上下文
+        token_budget = router_config.get("context_token_budget", 800)
+        if token_budget > 0:
+            prompt_text = self.compressor.fit_text(user_text, token_budget // 2)
+            context_budget = max(token_budget - estimate_tokens(prompt_text), 0)
+        else:
+            prompt_text = user_text
+            context_budget = 0
+
         context_section = ""
-        if contexts and len(contexts) > 0:
+        if contexts and len(contexts) > 0 and context_limit > 0 and (token_budget <= 0 or context_budget > 0):
             # context_turns is number of rounds (1 round = user + assistant), so multiply by 2 for messages
             message_limit = context_limit * 2
-            recent_contexts = contexts[-message_limit:] if len(contexts) > message_limit else contexts
-            context_lines = []
-            for msg in recent_contexts:
+            recent_contexts = []
+            for msg in contexts[-message_limit:]:
                 # Handle both dict format and string format
                 if isinstance(msg, dict):
-                    role = msg.get("role", "user")
-                    content = msg.get("content", "")[:200]  # Truncate long messages
+                    recent_contexts.append({"role": msg.get("role", "user"), "content": msg.get("content", "")})
                 elif isinstance(msg, str):
-                    role = "unknown"
-                    content = msg[:200]
-                else:
-                    continue  # Skip invalid format
-                if content:
-                    context_lines.append(f"[{role}]: {content}")
+                    recent_contexts.append({"role": "unknown", "content": msg})
+                # Skip invalid format
+            recent_contexts = self.compressor.compress(recent_contexts, context_budget, session_id)
+            context_lines = [f"[{msg['role']}]: {msg['content']}" for msg in recent_contexts]
             if context_lines:
                 context_section = "\n\nRecent Conversation Context:\n" + "\n".join(context_lines)
         
@@ -233,7 +407,7 @@ For user-defined categories, follow general principles:
             # 兜底：追加快照信息
             system_prompt += f"\n\n{snapshots_section}"
 
-        prompt = f"{context_section}\n\nCurrent User Input: {user_text}\n\nOutput JSON object."
+        prompt = f"{context_section}\n\nCurrent User Input: {prompt_text}\n\nOutput JSON object."
         
         try:
             logger.debug("Sending request to Router Model...")
@@ -257,8 +431,11 @@ For user-defined categories, follow general principles:
             
             # --- 缓存结果 ---
             self._set_cached(cache_key, data)
+            self._set_cached(self._get_text_key(user_text), data, cache=self._text_cache)
+            self._remember(session_id, user_text, data)
+            self.source_counts["router"] += 1
             
-            return data
+            return {**data, "route_source": "router"}
             
         except json.JSONDecodeError as e:
             logger.error(f"Router JSON Parse Error: {e}. Raw: {raw_text}")